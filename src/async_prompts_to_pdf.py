@@ -5,10 +5,25 @@
 import os
 import sys
 import re
+import json
+import hashlib
 import asyncio
 from pathlib import Path
+import httpx
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import (
+    AsyncOpenAI,
+    APIConnectionError,
+    APITimeoutError,
+    InternalServerError,
+    RateLimitError,
+)
+from tenacity import (
+    retry,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
 from markdown_pdf import MarkdownPdf, Section
 
 # Optional: for Word/EPUB output
@@ -37,11 +52,21 @@ optimize               = False
 use_web_search         = False
 max_output_tokens      = 2000
 max_concurrent_requests= 20   # concurrency for async calls
+use_batch_api          = False  # send real runs through the Batch API (50% cheaper, may take up to 24h)
+batch_poll_interval    = 30   # seconds between Batch API status checks
+prompts_per_request    = 1    # >1 packs that many prompt lines into one API call
+cache_dir              = Path(".prompt_cache")  # AI answers cached here across runs
 
 # %% [markdown]
 # # Helper function definitions
 
 # %%
+# Optional per-file system prompt in a fenced ```system ... ``` block
+_FENCED_SYSTEM_RE = re.compile(r"```system\s*(.*?)```", re.DOTALL | re.IGNORECASE)
+
+# Splits a combined answer on its "### Prompt N:" delimiter lines
+_MULTI_PROMPT_SPLIT_RE = re.compile(r"^###\s*Prompt\s+(\d+):[^\n]*$", re.MULTILINE)
+
 def extract_system_prompt_and_body(text):
     """
     Extract an OPTIONAL additional system prompt from `text`, supporting two formats:
@@ -53,11 +78,7 @@ def extract_system_prompt_and_body(text):
     Returns: (system_prompt_or_None, remaining_text_without_block)
     """
     # Try fenced ```system ... ``` first
-    fenced_pattern = re.compile(
-        r"```system\s*(.*?)```",
-        re.DOTALL | re.IGNORECASE
-    )
-    m = fenced_pattern.search(text)
+    m = _FENCED_SYSTEM_RE.search(text)
     if m:
         sys_prompt = m.group(1).strip()
         remaining = text[:m.start()] + text[m.end():]
@@ -66,148 +87,542 @@ def extract_system_prompt_and_body(text):
     # None found
     return (None, text)
 
-def generate_markdown_from_prompt(user_prompt, client, extra_system_prompt=None):
+def parse_prompt_lines(prompts_text):
+    """
+    Classify every non-blank line of prompts_text in one pass.
+    Returns a list of (idx, is_header, body) tuples, idx counting from 1;
+    body is the stripped line and header lines are the ones starting with "#".
+    """
+    # isspace() rejects blank lines without allocating a stripped copy;
+    # each remaining line is stripped exactly once
+    bodies = (
+        ln.strip() for ln in prompts_text.splitlines()
+        if ln and not ln.isspace()
+    )
+    return [
+        (idx, body[:1] == "#", body)
+        for idx, body in enumerate(bodies, start=1)
+    ]
+
+def build_request_body(user_prompt, extra_system_prompt=None):
     """
-    Synchronous call to OpenAI – returns a Markdown snippet.
+    Build the Responses API request body for one prompt line.
     If extra_system_prompt is provided, it is *added* as an additional system message
     after the hard-coded system prompt.
     """
-    try:
-        base_system = (
-            "Provide output in Markdown. "
-            "Use **bold** text for headers and no need for h1, h2, h3 headers. "
-            "Don't add line separators in response. "
-            f"Aim at about {max_output_tokens} tokens."
-        )
+    base_system = (
+        "Provide output in Markdown. "
+        "Use **bold** text for headers and no need for h1, h2, h3 headers. "
+        "Don't add line separators in response. "
+        f"Aim at about {max_output_tokens} tokens."
+    )
+
+    prompt = [
+        {"role": "system", "content": base_system},
+    ]
+
+    # If the file provided additional system instructions, add them here
+    if extra_system_prompt:
+        prompt.append({"role": "system", "content": extra_system_prompt})
 
-        prompt = [
-            {"role": "system", "content": base_system},
-        ]
+    prompt.append({"role": "user", "content": user_prompt + "\n\n"})
 
-        # If the file provided additional system instructions, add them here
-        if extra_system_prompt:
-            prompt.append({"role": "system", "content": extra_system_prompt})
+    tools = [{"type": "web_search_preview"}] if use_web_search else []
+    return {"model": model, "tools": tools, "input": prompt}
 
-        prompt.append({"role": "user", "content": user_prompt + "\n\n"})
+def response_cache_path(request_body):
+    """Disk-cache location of the answer to `request_body` (SHA256 of the whole body)."""
+    key = hashlib.sha256(
+        json.dumps(request_body, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+    return cache_dir / f"{key}.md"
 
-        tools = [{"type": "web_search_preview"}] if use_web_search else []
-        response = client.responses.create(
-            model=model,
-            tools=tools,
-            input=prompt
+def read_cached_answer(user_prompt, extra_system_prompt=None):
+    """Return the cached answer text for a prompt line, or None on a cache miss."""
+    path = response_cache_path(build_request_body(user_prompt, extra_system_prompt))
+    return path.read_text(encoding="utf-8") if path.exists() else None
+
+def write_cached_answer(user_prompt, extra_system_prompt, output_text):
+    """
+    Store the answer text for a prompt line so later runs can skip the API call.
+    Best effort: a failed write only prints a warning, the answer is still used.
+    """
+    path = response_cache_path(build_request_body(user_prompt, extra_system_prompt))
+    try:
+        path.write_text(output_text.strip(), encoding="utf-8")
+    except Exception as e:
+        print(f"⚠️  Could not cache answer for prompt '{user_prompt}': {e}")
+
+@retry(
+    stop=stop_after_attempt(5),
+    wait=wait_random_exponential(min=1, max=30),
+    retry=retry_if_exception_type((
+        RateLimitError, APITimeoutError, APIConnectionError, InternalServerError,
+        # Raised unwrapped when the connection drops while the stream is being read
+        httpx.TransportError,
+    )),
+    reraise=True,
+)
+async def stream_output_text(client, **request_body):
+    """
+    Stream a Responses API answer and return its full output text.
+    Retried with exponential backoff + jitter on transient errors
+    (429, 5xx, timeouts, dropped connections).
+    """
+    parts = []
+    # tenacity owns retries here; SDK retries on top would multiply the attempts
+    stream_client = client.with_options(max_retries=0)
+    async with stream_client.responses.stream(**request_body) as stream:
+        async for event in stream:
+            if event.type == "response.output_text.delta":
+                parts.append(event.delta)
+        # A failed/incomplete generation must not be cached or rendered as an answer
+        final = await stream.get_final_response()
+    if final.status != "completed":
+        raise RuntimeError(f"Response ended with status '{final.status}'")
+    return "".join(parts)
+
+def format_prompt_markdown(user_prompt, output_text):
+    """Wrap an AI answer in the separator + **Prompt:** block used in the output."""
+    separator = "\n\n===========================\n\n"
+    return f"{separator}**Prompt:** {user_prompt}\n\n" + output_text.strip()
+
+def format_error_markdown(user_prompt):
+    """Placeholder inserted when no answer could be generated for a prompt."""
+    return f"**Prompt:** {user_prompt}\n\n*Error generating content.*"
+
+async def generate_markdown_from_prompt(user_prompt, client, extra_system_prompt=None):
+    """
+    Asynchronous call to OpenAI – returns a Markdown snippet.
+    """
+    try:
+        output_text = await stream_output_text(
+            client, **build_request_body(user_prompt, extra_system_prompt)
         )
-        separator = "\n\n===========================\n\n"
-        text = f"{separator}**Prompt:** {user_prompt}\n\n" + response.output_text.strip()
-        return text
+        write_cached_answer(user_prompt, extra_system_prompt, output_text)
+        return format_prompt_markdown(user_prompt, output_text)
     except Exception as e:
         print(f"AI request failed for prompt '{user_prompt}': {e}")
-        return f"**Prompt:** {user_prompt}\n\n*Error generating content.*"
+        return format_error_markdown(user_prompt)
+
+async def generate_markdown_for_prompts(user_prompts, client, extra_system_prompt=None):
+    """
+    Answer several prompts with ONE OpenAI call.
+    Returns a list of Markdown snippets (same order as user_prompts), or None if
+    the call failed or the numbered sections could not be parsed from the answer.
+    """
+    numbered = "\n".join(
+        f"Prompt {n}: {user_prompt}" for n, user_prompt in enumerate(user_prompts, start=1)
+    )
+    body = build_request_body(
+        "Respond to each prompt as a separate section, each starting with "
+        f"'### Prompt N:'.\n\n{numbered}",
+        extra_system_prompt
+    )
+    # Delimiter instructions go right before the user message
+    body["input"].insert(-1, {"role": "system", "content": (
+        "You will receive several numbered prompts. Answer each one separately. "
+        "Start the answer to prompt N with a line containing only '### Prompt N:' "
+        "and use no other '### Prompt' lines. The token target applies to each answer."
+    )})
+    try:
+        output_text = await stream_output_text(client, **body)
+    except Exception as e:
+        print(f"AI request failed for {len(user_prompts)} combined prompts: {e}")
+        return None
+
+    # re.split with a capture group → [preamble, "1", answer1, "2", answer2, ...]
+    parts = _MULTI_PROMPT_SPLIT_RE.split(output_text)
+    numbers = [int(n) for n in parts[1::2]]
+    if numbers != list(range(1, len(user_prompts) + 1)):
+        return None
+    answers = parts[2::2]
+    for user_prompt, answer in zip(user_prompts, answers):
+        write_cached_answer(user_prompt, extra_system_prompt, answer)
+    return [
+        format_prompt_markdown(user_prompt, answer)
+        for user_prompt, answer in zip(user_prompts, answers)
+    ]
 
-async def process_prompts_to_markdown(prompts_text, client, concurrency, dry_run=False, extra_system_prompt=None):
+async def process_prompts_to_markdown(prompts_text, client, concurrency, dry_run=False, extra_system_prompt=None, out_queue=None):
     """
     Turn each non-blank line of prompts_text into either:
       - header lines (starting "#"), passed through
       - AI-generated Markdown for each other line
+    Prompt lines are sent `prompts_per_request` at a time; answers already in
+    `cache_dir` are reused without an API call, and a line repeating an
+    earlier prompt reuses that prompt's answer.
+    If out_queue is given, every piece is put on it in document order as soon
+    as it is ready, followed by a None sentinel.
+    Requests are made by a fixed pool of `concurrency` workers.
     Returns the full concatenated Markdown document.
     """
-    lines = [ln for ln in prompts_text.splitlines() if ln.strip()]
+    if concurrency < 1:
+        raise ValueError(f"concurrency must be at least 1, got {concurrency}")
+    lines = parse_prompt_lines(prompts_text)
     total = len(lines)
-    semaphore = asyncio.Semaphore(concurrency)
 
     async def fetch_markdown(stripped, idx):
-        if stripped.startswith("#"):
-            return stripped
-        async with semaphore:
-            if dry_run:
-                return f"**Prompt:** {stripped}\n\n_test placeholder_\n"
-            print(f"Processing AI call {idx}/{total}…")
-            loop = asyncio.get_running_loop()
-            return await loop.run_in_executor(
-                None,
-                generate_markdown_from_prompt,
-                stripped,
-                client,
-                extra_system_prompt
-            )
+        if dry_run:
+            return f"**Prompt:** {stripped}\n\n_test placeholder_\n"
+        print(f"Processing AI call {idx}/{total}…")
+        return await generate_markdown_from_prompt(
+            stripped,
+            client,
+            extra_system_prompt
+        )
 
-    tasks = [
-        asyncio.create_task(fetch_markdown(line.lstrip(), idx))
-        for idx, line in enumerate(lines, start=1)
+    async def fetch_group(group):
+        if dry_run or len(group) == 1:
+            return [await fetch_markdown(stripped, idx) for idx, stripped in group]
+        print(f"Processing AI calls {group[0][0]}–{group[-1][0]}/{total}…")
+        group_md = await generate_markdown_for_prompts(
+            [stripped for _, stripped in group],
+            client,
+            extra_system_prompt
+        )
+        if group_md is None:
+            # Could not split the combined answer – ask for each prompt separately
+            print(f"Falling back to single calls for lines {group[0][0]}–{group[-1][0]}")
+            group_md = [await fetch_markdown(stripped, idx) for idx, stripped in group]
+        return group_md
+
+    # Header lines pass through as-is; prompt slots are filled from the
+    # cache here or from the API below
+    pieces = [body for _, _, body in lines]
+    prompts = []
+    first_idx = {}    # prompt text -> line idx of its first occurrence
+    duplicates = {}   # line idx -> line idx of the identical earlier prompt
+    for idx, is_header, stripped in lines:
+        if is_header:
+            continue
+        if stripped in first_idx:
+            duplicates[idx] = first_idx[stripped]
+            continue
+        first_idx[stripped] = idx
+        cached = None if dry_run else read_cached_answer(stripped, extra_system_prompt)
+        if cached is None:
+            prompts.append((idx, stripped))
+        else:
+            pieces[idx - 1] = format_prompt_markdown(stripped, cached)
+    groups = [
+        prompts[i:i + prompts_per_request]
+        for i in range(0, len(prompts), prompts_per_request)
     ]
-    pieces = await asyncio.gather(*tasks)
+
+    # line idx -> (group number, position within that group)
+    pending = {}
+    work = asyncio.Queue()
+    for g, group in enumerate(groups):
+        work.put_nowait((g, group))
+        for pos, (idx, _) in enumerate(group):
+            pending[idx] = (g, pos)
+    group_results = [None] * len(groups)
+    results_ready = asyncio.Condition()
+
+    async def worker():
+        while (item := await work.get()) is not None:
+            g, group = item
+            try:
+                group_md = await fetch_group(group)
+            except Exception as e:
+                print(f"AI request failed for lines {group[0][0]}–{group[-1][0]}: {e}")
+                group_md = [format_error_markdown(stripped) for _, stripped in group]
+            async with results_ready:
+                group_results[g] = group_md
+                results_ready.notify_all()
+
+    # The pool size is the concurrency limit: only `concurrency` coroutines
+    # exist no matter how many prompt lines the file has
+    n_workers = min(concurrency, len(groups))
+    for _ in range(n_workers):
+        work.put_nowait(None)
+    workers = [asyncio.create_task(worker()) for _ in range(n_workers)]
+
+    try:
+        # Collect in document order so out_queue consumers can start early
+        for idx in range(1, total + 1):
+            if idx in pending:
+                g, pos = pending[idx]
+                async with results_ready:
+                    await results_ready.wait_for(lambda: group_results[g] is not None)
+                pieces[idx - 1] = group_results[g][pos]
+            elif idx in duplicates:
+                pieces[idx - 1] = pieces[duplicates[idx] - 1]
+            if out_queue is not None:
+                await out_queue.put(pieces[idx - 1])
+        if out_queue is not None:
+            await out_queue.put(None)
+    finally:
+        for task in workers:
+            task.cancel()  # no-op for workers that already hit their sentinel
     return "\n\n".join(pieces)
 
-# %% [markdown]
-# # Main
+def extract_output_text(body):
+    """
+    Collect the assistant text from a raw Responses API body – the JSON
+    equivalent of the SDK's `response.output_text`.
+    """
+    return "".join(
+        part.get("text", "")
+        for item in body.get("output", [])
+        if item.get("type") == "message"
+        for part in item.get("content", [])
+        if part.get("type") == "output_text"
+    )
 
-# %%
-async def main():
-    css = Path("src/custom.css").read_text(encoding="utf-8")
+async def run_batch(requests, client):
+    """
+    Submit `requests` ({custom_id: request_body}) as one Batch API job, poll
+    until it finishes and return {custom_id: output_text}.
+    Requests that failed inside the batch are missing from the result; errors
+    after submission are re-raised with the batch id so it can be recovered.
+    """
+    jsonl = "\n".join(
+        json.dumps({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/responses",
+            "body": body,
+        })
+        for custom_id, body in requests.items()
+    )
+    batch_file = await client.files.create(
+        file=("prompts_batch.jsonl", jsonl.encode("utf-8")),
+        purpose="batch"
+    )
+    batch = await client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/responses",
+        completion_window="24h"
+    )
+    print(f"📦  Submitted batch {batch.id} with {len(requests)} requests")
 
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        print("Environment variable OPENAI_API_KEY is not set.")
-        sys.exit(1)
+    try:
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            await asyncio.sleep(batch_poll_interval)
+            batch = await client.batches.retrieve(batch.id)
+            print(f"⏳  Batch {batch.id}: {batch.status}")
+
+        if batch.status != "completed":
+            print(f"❌  Batch {batch.id} ended with status '{batch.status}'")
+
+        # Expired batches may still carry partial results
+        outputs = {}
+        if batch.output_file_id:
+            content = await client.files.content(batch.output_file_id)
+            for raw in content.text.splitlines():
+                if not raw or raw.isspace():
+                    continue
+                try:
+                    record = json.loads(raw)
+                except json.JSONDecodeError as e:
+                    print(f"❌  Skipping malformed line in batch {batch.id} output: {e}")
+                    continue
+                response = record.get("response") or {}
+                if response.get("status_code") == 200:
+                    outputs[record["custom_id"]] = extract_output_text(response["body"])
+        return outputs
+    except Exception as e:
+        raise RuntimeError(f"batch {batch.id}: {e}") from e
 
-    client = OpenAI(api_key=api_key)
-    output_dir = Path("results")
-    output_dir.mkdir(parents=True, exist_ok=True)
+async def process_prompts_with_batch(prompts_text, client, extra_system_prompt=None, out_queue=None):
+    """
+    Same output as process_prompts_to_markdown, but every AI prompt that is not
+    already cached is sent through the Batch API in a single job instead of
+    live requests. Repeated prompts are only requested once.
+    out_queue (if given) receives the pieces once the batch is done.
+    """
+    lines = parse_prompt_lines(prompts_text)
+    outputs = {}
+    requests = {}
+    first_idx = {}    # prompt text -> line idx of its first occurrence
+    for idx, is_header, stripped in lines:
+        if is_header or stripped in first_idx:
+            continue
+        first_idx[stripped] = idx
+        cached = read_cached_answer(stripped, extra_system_prompt)
+        if cached is None:
+            requests[f"line-{idx}"] = build_request_body(stripped, extra_system_prompt)
+        else:
+            outputs[f"line-{idx}"] = cached
+    if requests:
+        try:
+            batch_outputs = await run_batch(requests, client)
+        except Exception as e:
+            # Same as the live path: failed prompts become error placeholders
+            print(f"❌  Batch API run failed: {e}")
+            batch_outputs = {}
+        for custom_id, output_text in batch_outputs.items():
+            idx = int(custom_id.split("-", 1)[1])
+            write_cached_answer(lines[idx - 1][2], extra_system_prompt, output_text)
+        outputs.update(batch_outputs)
+
+    pieces = []
+    for idx, is_header, stripped in lines:
+        custom_id = None if is_header else f"line-{first_idx[stripped]}"
+        if is_header:
+            pieces.append(stripped)
+        elif custom_id in outputs:
+            pieces.append(format_prompt_markdown(stripped, outputs[custom_id]))
+        else:
+            print(f"AI request failed for prompt '{stripped}': missing from batch output")
+            pieces.append(format_error_markdown(stripped))
+    if out_queue is not None:
+        for piece in pieces:
+            await out_queue.put(piece)
+        await out_queue.put(None)
+    return "\n\n".join(pieces)
 
-    for prompts_filename in prompts_filenames:
-        # Derive paths based on each prompt file
-        prompt_path = Path(prompts_filename)
-        stem = prompt_path.stem
-        output_file = output_dir / f"{stem}.{output_format}"
+async def pdf_writer(queue, pdf, css):
+    """
+    Drain Markdown pieces from `queue` into `pdf` until the None sentinel.
+    A Section is added for every top-level ("# ") heading as soon as the next
+    one arrives, so PDF layout runs in a thread while API calls are in flight.
+    Returns True if every section was added. After an error no more sections
+    are laid out, but the queue is still drained so the producer never blocks.
+    """
+    section_pieces = []
+    ok = True
 
-        # Read prompts
+    async def add_section():
+        nonlocal ok
+        if not ok:
+            return
         try:
-            with open(prompts_filename, "r", encoding="utf-8") as f:
-                full_text = f.read()
-        except FileNotFoundError:
-            print(f"❌  Prompt file not found: {prompts_filename}")
-            continue
+            await asyncio.to_thread(
+                pdf.add_section, Section("\n\n".join(section_pieces)), user_css=css
+            )
+        except Exception as e:
+            print(f"❌  Failed to add PDF section: {e}")
+            ok = False
+
+    while (piece := await queue.get()) is not None:
+        if piece.startswith("# ") and section_pieces:
+            await add_section()
+            section_pieces = []
+        section_pieces.append(piece)
+    if section_pieces:
+        await add_section()
+    return ok
+
+async def markdown_file_writer(queue, path):
+    """
+    Drain Markdown pieces from `queue` into the file at `path` until the
+    None sentinel (input for pandoc).
+    Returns True if every piece was written. After an error the queue is
+    still drained so the producer never blocks on a full queue.
+    """
+    f = None
+    try:
+        f = open(path, "w", encoding="utf-8")
+    except Exception as e:
+        print(f"❌  Failed to open {path}: {e}")
 
-        # ⬇️ NEW: Extract optional per-file system prompt
-        extra_system_prompt, chatgpt_prompts = extract_system_prompt_and_body(full_text)
+    try:
+        separator = ""
+        while (piece := await queue.get()) is not None:
+            if f is None:
+                continue
+            try:
+                f.write(separator + piece)
+            except Exception as e:
+                print(f"❌  Failed to write {path}: {e}")
+                f.close()
+                f = None
+            separator = "\n\n"
+    finally:
+        if f is not None:
+            f.close()
+    return f is not None
 
-        print(f"\n🚧  Starting dry run for '{prompts_filename}'…")
-        markdown_dry = await process_prompts_to_markdown(
-            chatgpt_prompts, client,
-            concurrency=max_concurrent_requests,
-            dry_run=True,
-            extra_system_prompt=extra_system_prompt
-        )
-        # Write and delete a tiny sample to verify
-        dry_sample = output_dir / f"{stem}_dry.md"
-        with open(dry_sample, "w", encoding="utf-8") as f:
-            f.write(markdown_dry[:2000])
-        print(f"✔️  Dry-run Markdown sample saved to {dry_sample}")
-        dry_sample.unlink()
-        print(f"🗑️  Deleted dry-run sample")
-
-        print(f"✅  Dry run complete for '{prompts_filename}' — generating real content…")
-        full_markdown = await process_prompts_to_markdown(
-            chatgpt_prompts, client,
-            concurrency=max_concurrent_requests,
-            dry_run=False,
-            extra_system_prompt=extra_system_prompt
-        )
+# %%
+async def process_prompt_file(prompts_filename, client, css, output_dir):
+    """
+    Run the dry run and the real run for one prompt file and write the
+    result in `output_format` to `output_dir`.
+    """
+    # Derive paths based on each prompt file
+    prompt_path = Path(prompts_filename)
+    stem = prompt_path.stem
+    output_file = output_dir / f"{stem}.{output_format}"
+
+    # Read prompts (in a thread, off the event loop)
+    try:
+        full_text = await asyncio.to_thread(prompt_path.read_text, encoding="utf-8")
+    except FileNotFoundError:
+        print(f"❌  Prompt file not found: {prompts_filename}")
+        return
+
+    # ⬇️ NEW: Extract optional per-file system prompt
+    extra_system_prompt, chatgpt_prompts = extract_system_prompt_and_body(full_text)
+
+    print(f"\n🚧  Starting dry run for '{prompts_filename}'…")
+    markdown_dry = await process_prompts_to_markdown(
+        chatgpt_prompts, client,
+        concurrency=max_concurrent_requests,
+        dry_run=True,
+        extra_system_prompt=extra_system_prompt
+    )
+    # Write and delete a tiny sample to verify
+    dry_sample = output_dir / f"{stem}_dry.md"
+    await asyncio.to_thread(dry_sample.write_text, markdown_dry[:2000], encoding="utf-8")
+    print(f"✔️  Dry-run Markdown sample saved to {dry_sample}")
+    await asyncio.to_thread(dry_sample.unlink)
+    print(f"🗑️  Deleted dry-run sample")
+
+    # Pick the consumer that turns finished pieces into the output file
+    queue = asyncio.Queue(maxsize=max_concurrent_requests * 2)
+    markdown_file = None
+    if output_format == "pdf":
+        pdf = MarkdownPdf(toc_level=toc_level, optimize=optimize)
+        writer = asyncio.create_task(pdf_writer(queue, pdf, css))
+    elif output_format in ("docx", "epub"):
+        markdown_file = output_dir / f"{stem}.tmp.md"
+        writer = asyncio.create_task(markdown_file_writer(queue, markdown_file))
+    else:
+        print(f"❌  Unknown output_format '{output_format}'. Choose 'pdf', 'docx', or 'epub'.")
+        sys.exit(1)
+
+    print(f"✅  Dry run complete for '{prompts_filename}' — generating real content…")
+    try:
+        try:
+            if use_batch_api:
+                await process_prompts_with_batch(
+                    chatgpt_prompts, client,
+                    extra_system_prompt=extra_system_prompt,
+                    out_queue=queue
+                )
+            else:
+                await process_prompts_to_markdown(
+                    chatgpt_prompts, client,
+                    concurrency=max_concurrent_requests,
+                    dry_run=False,
+                    extra_system_prompt=extra_system_prompt,
+                    out_queue=queue
+                )
+            written = await writer
+        finally:
+            writer.cancel()  # no-op once the writer has finished
+
+        # Save in the desired format
+        if not written:
+            print(f"❌  Failed to generate {output_format.upper()} for '{stem}': document incomplete, not saved")
 
-        # Convert and save in the desired format
-        if output_format == "pdf":
-            pdf = MarkdownPdf(toc_level=toc_level, optimize=optimize)
-            pdf.add_section(Section(full_markdown), user_css=css)
+        elif output_format == "pdf":
             try:
-                pdf.save(str(output_file))
+                # Saving lays out and writes the whole document – keep it off the loop
+                await asyncio.to_thread(pdf.save, str(output_file))
                 print(f"🎉  Final PDF saved to {output_file}")
             except Exception as e:
                 print(f"❌  Failed to save PDF for '{stem}': {e}")
-                continue
 
-        elif output_format in ("docx", "epub"):
+        else:
             try:
-                pypandoc.convert_text(
-                    full_markdown,
+                # pandoc runs as a blocking subprocess – keep it off the event loop
+                await asyncio.to_thread(
+                    pypandoc.convert_file,
+                    str(markdown_file),
                     to=output_format,
                     format="md",
                     outputfile=str(output_file)
@@ -215,11 +630,60 @@ async def main():
                 print(f"🎉  Final {output_format.upper()} saved to {output_file}")
             except Exception as e:
                 print(f"❌  Failed to generate {output_format.upper()} for '{stem}': {e}")
-                continue
+    finally:
+        # The temporary pandoc input never outlives this prompt file
+        if markdown_file is not None:
+            markdown_file.unlink(missing_ok=True)
 
-        else:
-            print(f"❌  Unknown output_format '{output_format}'. Choose 'pdf', 'docx', or 'epub'.")
-            sys.exit(1)
+async def warm_up_connection(client):
+    """
+    Open the connection to the API with one cheap request, so the first burst
+    of prompts reuses it instead of each paying for a TLS handshake.
+    """
+    try:
+        await client.models.list()
+    except Exception as e:
+        print(f"Connection warm-up failed (continuing anyway): {e}")
+
+# %% [markdown]
+# # Main
+
+# %%
+async def main():
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        print("Environment variable OPENAI_API_KEY is not set.")
+        sys.exit(1)
+    if max_concurrent_requests < 1:
+        print(f"❌  max_concurrent_requests must be at least 1, got {max_concurrent_requests}.")
+        sys.exit(1)
+
+    # One HTTP/2 connection pool shared by every request (dry and real runs),
+    # so concurrent calls multiplex over a single TLS connection.
+    http_client = httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(600, connect=5),
+        limits=httpx.Limits(
+            max_connections=100,
+            max_keepalive_connections=100,
+            keepalive_expiry=30
+        )
+    )
+    client = AsyncOpenAI(api_key=api_key, http_client=http_client)
+    output_dir = Path("results")
+    output_dir.mkdir(parents=True, exist_ok=True)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    try:
+        # Read the CSS in a thread while the API connection warms up
+        css, _ = await asyncio.gather(
+            asyncio.to_thread(Path("src/custom.css").read_text, encoding="utf-8"),
+            warm_up_connection(client)
+        )
+        for prompts_filename in prompts_filenames:
+            await process_prompt_file(prompts_filename, client, css, output_dir)
+    finally:
+        await client.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
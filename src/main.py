@@ -4,23 +4,67 @@ Generate a PDF guide from a YAML specification of prompts.
 
 Usage:
     python main.py --input prompts.yaml --output result.pdf \
-        [--model gpt-4.1-mini] [--toc-level 3] [--optimize] [--no-web-search] [--verbose]
+        [--model gpt-4.1-mini] [--toc-level 3] [--optimize] [--no-web-search] \
+        [--max-concurrent 20] [--cache-dir .prompt_cache] [--verbose]
 """
 
 import argparse
+import asyncio
+import hashlib
+import json
 import logging
 from pathlib import Path
 import os
 import sys
-from typing import Any, Dict, List, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 
+import httpx
 import yaml
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import (
+    AsyncOpenAI,
+    APIConnectionError,
+    APITimeoutError,
+    InternalServerError,
+    RateLimitError,
+)
+from tenacity import (
+    retry,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
 from markdown_pdf import MarkdownPdf, Section
 
+try:
+    # libyaml C extension – much faster on large YAML files
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 # Type alias for YAML data
 YamlNode = Union[Dict[str, Any], List[Any], str]
+# Dict keys / list indices leading from the YAML root to a leaf prompt
+LeafPath = Tuple[Any, ...]
+
+SYSTEM_PROMPT = (
+    "You are a tutor preparing me to the SnowPro® Advanced: Data Engineer (DEA-C02) certification. "
+    "Provide output in Markdown. "
+    "Use **bold** for headers. "
+    "Don't add line separators in response. "
+)
+
+def positive_int(value: str) -> int:
+    """
+    argparse type for options that must be an integer >= 1.
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid integer value: {value!r}")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(
@@ -56,6 +100,14 @@ def parse_args() -> argparse.Namespace:
         "--no-web-search", action="store_false", dest="use_web_search",
         help="Disable web search in AI prompts",
     )
+    parser.add_argument(
+        "--max-concurrent", type=positive_int, default=20,
+        help="Maximum number of concurrent AI requests (default: 20)",
+    )
+    parser.add_argument(
+        "--cache-dir", default=".prompt_cache",
+        help="Directory where AI responses are cached between runs (default: .prompt_cache)",
+    )
     parser.add_argument(
         "--verbose", action="store_true",
         help="Enable verbose logging",
@@ -69,59 +121,187 @@ def setup_logging(verbose: bool) -> None:
         level=level,
     )
 
-def load_yaml_file(path: str) -> Dict[str, YamlNode]:
+def load_yaml_file(path: str) -> Optional[Dict[str, YamlNode]]:
+    """
+    Parse the YAML file at `path`; logs the reason and returns None when it
+    cannot be read or holds no document.
+    """
     try:
         with open(path, "r", encoding="utf-8") as f:
-            return yaml.safe_load(f)
+            data = yaml.load(f, Loader=SafeLoader)
     except Exception as e:
         logging.error("Failed to load YAML file %s: %s", path, e)
-        sys.exit(1)
+        return None
+    if data is None:
+        logging.error("YAML file %s is empty", path)
+    return data
 
-def generate_markdown_from_node(
-    node: YamlNode,
-    client: OpenAI,
+def cache_path(cache_dir: Path, model: str, prompt: str, use_web_search: bool) -> Path:
+    """
+    Location of the cached AI response for one leaf prompt.
+    """
+    key = hashlib.sha256(
+        json.dumps([model, prompt, use_web_search, SYSTEM_PROMPT]).encode("utf-8")
+    ).hexdigest()
+    return cache_dir / f"{key}.md"
+
+async def warm_up_connection(client: AsyncOpenAI) -> None:
+    """
+    Open the connection to the API with one cheap request, so the first burst
+    of leaf prompts reuses it instead of each paying for a TLS handshake.
+    """
+    try:
+        await client.models.list()
+    except Exception as e:
+        logging.debug("Connection warm-up failed (continuing anyway): %s", e)
+
+def collect_leaf_prompts(node: YamlNode, path: LeafPath = ()) -> List[Tuple[LeafPath, str]]:
+    """
+    Pass 1: walk the YAML tree and collect (path, prompt) for every leaf string.
+    The path is the tuple of dict keys / list indices leading to the leaf.
+    """
+    leaves: List[Tuple[LeafPath, str]] = []
+    if isinstance(node, dict):
+        for key, val in node.items():
+            leaves.extend(collect_leaf_prompts(val, path + (key,)))
+    elif isinstance(node, list):
+        for i, item in enumerate(node):
+            leaves.extend(collect_leaf_prompts(item, path + (i,)))
+    else:
+        leaves.append((path, node))
+    return leaves
+
+@retry(
+    stop=stop_after_attempt(5),
+    wait=wait_random_exponential(min=1, max=30),
+    retry=retry_if_exception_type((
+        RateLimitError, APITimeoutError, APIConnectionError, InternalServerError,
+        # Raised unwrapped when the connection drops while the stream is being read
+        httpx.TransportError,
+    )),
+    reraise=True,
+)
+async def stream_output_text(client: AsyncOpenAI, **request_body: Any) -> str:
+    """
+    Stream a Responses API answer and return its full output text.
+    Retried with exponential backoff + jitter on transient errors
+    (429, 5xx, timeouts, dropped connections).
+    """
+    parts: List[str] = []
+    # tenacity owns retries here; SDK retries on top would multiply the attempts
+    stream_client = client.with_options(max_retries=0)
+    async with stream_client.responses.stream(**request_body) as stream:
+        async for event in stream:
+            if event.type == "response.output_text.delta":
+                parts.append(event.delta)
+        # A failed/incomplete generation must not be cached or rendered as an answer
+        final = await stream.get_final_response()
+    if final.status != "completed":
+        raise RuntimeError(f"Response ended with status '{final.status}'")
+    return "".join(parts)
+
+async def generate_leaf_response(
+    prompt: str,
+    client: AsyncOpenAI,
+    model: str,
+    use_web_search: bool,
+    cache_dir: Path,
+) -> Optional[str]:
+    """
+    Return the AI response for one leaf prompt, or None if the request failed.
+    Responses already present in cache_dir are reused without an API call.
+    """
+    try:
+        cached = cache_path(cache_dir, model, prompt, use_web_search)
+        if cached.exists():
+            logging.debug("Using cached response for node '%s'", prompt)
+            return cached.read_text(encoding="utf-8")
+
+        messages = [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": prompt},
+        ]
+        tools = [{"type": "web_search_preview"}] if use_web_search else []
+        logging.debug("Requesting AI response for node '%s'", prompt)
+        output_text = await stream_output_text(
+            client,
+            model=model,
+            tools=tools,
+            input=messages,
+        )
+        output_text = output_text.strip()
+    except Exception as e:
+        logging.error("AI request failed for node '%s': %s", prompt, e)
+        return None
+
+    # The cache is best effort – never lose a paid answer to a failed write
+    try:
+        cached.write_text(output_text, encoding="utf-8")
+    except Exception as e:
+        logging.warning("Could not cache response for node '%s': %s", prompt, e)
+    return output_text
+
+async def generate_leaf_responses(
+    leaves: List[Tuple[LeafPath, str]],
+    client: AsyncOpenAI,
     model: str,
     use_web_search: bool,
+    cache_dir: Path,
+    max_concurrent: int,
+) -> Dict[LeafPath, Optional[str]]:
+    """
+    Pass 2: fetch all leaf responses with a pool of max_concurrent workers.
+    A prompt that appears under several leaves is only requested once.
+    """
+    work: "asyncio.Queue[Optional[str]]" = asyncio.Queue()
+    for prompt in dict.fromkeys(prompt for _, prompt in leaves):
+        work.put_nowait(prompt)
+    n_workers = min(max_concurrent, work.qsize())
+    for _ in range(n_workers):
+        work.put_nowait(None)
+
+    by_prompt: Dict[str, Optional[str]] = {}
+
+    async def worker() -> None:
+        while (prompt := await work.get()) is not None:
+            by_prompt[prompt] = await generate_leaf_response(
+                prompt, client, model, use_web_search, cache_dir
+            )
+
+    await asyncio.gather(*(worker() for _ in range(n_workers)))
+    return {path: by_prompt[prompt] for path, prompt in leaves}
+
+def generate_markdown_from_node(
+    node: YamlNode,
+    responses: Dict[LeafPath, Optional[str]],
+    lines: List[str],
+    path: LeafPath = (),
     depth: int = 1
-) -> str:
+) -> None:
     """
-    Recursively convert a YAML node into Markdown, using AI for leaf strings.
+    Pass 3: recursively convert a YAML node into Markdown, inserting the AI
+    response fetched for each leaf string. Fragments are appended to `lines`
+    so the caller joins the whole section only once.
     """
-    lines: List[str] = []
     if isinstance(node, dict):
         for key, val in node.items():
             heading = "#" * (depth + 1) + f" {key}"
             lines.append(heading + "\n")
-            lines.append(generate_markdown_from_node(val, client, model, use_web_search, depth + 1))
+            generate_markdown_from_node(val, responses, lines, path + (key,), depth + 1)
     elif isinstance(node, list):
-        for item in node:
-            lines.append(generate_markdown_from_node(item, client, model, use_web_search, depth))
+        for i, item in enumerate(node):
+            generate_markdown_from_node(item, responses, lines, path + (i,), depth)
     else:
         # Leaf node (string)
-        try:
-            prompt = [
-                {"role": "system", "content": (
-                    "You are a tutor preparing me to the SnowPro® Advanced: Data Engineer (DEA-C02) certification. "
-                    "Provide output in Markdown. "
-                    "Use **bold** for headers. "
-                    "Don't add line separators in response. "
-                )},
-                {"role": "user", "content": node},
-            ]
-            tools = [{"type": "web_search_preview"}] if use_web_search else []
-            response = client.responses.create(
-                model=model,
-                tools=tools,
-                input=prompt,
-            )
-            text = f"Prompt: {node}\n\n" + response.output_text.strip()
-            lines.append(text + "\n\n---\n\n")
-        except Exception as e:
-            logging.error("AI request failed for node '%s': %s", node, e)
+        output_text = responses.get(path)
+        if output_text is None:
             lines.append(node + "\n\n---\n\n")
-    return "".join(lines)
+        else:
+            lines.append(f"Prompt: {node}\n\n")
+            lines.append(output_text)
+            lines.append("\n\n---\n\n")
 
-def main() -> None:
+async def main() -> None:
     args = parse_args()
     setup_logging(args.verbose)
     load_dotenv()
@@ -131,29 +311,56 @@ def main() -> None:
         logging.error("Environment variable OPENAI_API_KEY is not set.")
         sys.exit(1)
 
-    client = OpenAI(api_key=api_key)
+    # One HTTP/2 connection pool shared by all concurrent leaf requests
+    http_client = httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(600, connect=5),
+        limits=httpx.Limits(
+            max_connections=100,
+            max_keepalive_connections=100,
+            keepalive_expiry=30,
+        ),
+    )
+    client = AsyncOpenAI(api_key=api_key, http_client=http_client)
+    cache_dir = Path(args.cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
 
     logging.info("Loading YAML from %s", args.input)
-    data = load_yaml_file(args.input)
-
-    total_sections = len(data)
-    logging.info("Found %d top-level sections", total_sections)  # ← summary
+    try:
+        # Read the inputs in threads while the API connection warms up
+        data, css, _ = await asyncio.gather(
+            asyncio.to_thread(load_yaml_file, args.input),
+            asyncio.to_thread(Path("src/custom.css").read_text, encoding="utf-8"),
+            warm_up_connection(client),
+        )
+        if data is None:
+            sys.exit(1)
 
-    css = Path("src/custom.css").read_text(encoding="utf-8")
+        total_sections = len(data)
+        logging.info("Found %d top-level sections", total_sections)  # ← summary
 
-    # Generate content for each top-level section
-    all_sections_md: List[str] = []
-    for idx, (title, subtree) in enumerate(data.items(), start=1):
-        logging.info("=== Starting section %d/%d: %s ===", idx, total_sections, title)
-        section_md = f"# {title}\n\n"
-        section_md += generate_markdown_from_node(
-            subtree,
+        # Fetch every leaf prompt of every section concurrently
+        leaves = collect_leaf_prompts(data)
+        logging.info(
+            "Generating %d AI responses (up to %d at a time)", len(leaves), args.max_concurrent
+        )
+        responses = await generate_leaf_responses(
+            leaves,
             client=client,
             model=args.model,
             use_web_search=args.use_web_search,
-            depth=1
+            cache_dir=cache_dir,
+            max_concurrent=args.max_concurrent,
         )
-        all_sections_md.append(section_md)
+    finally:
+        await client.close()
+
+    # Assemble one Markdown document per top-level section
+    all_sections_md: List[str] = []
+    for idx, (title, subtree) in enumerate(data.items(), start=1):
+        section_lines = [f"# {title}\n\n"]
+        generate_markdown_from_node(subtree, responses, section_lines, path=(title,), depth=1)
+        all_sections_md.append("".join(section_lines))
         logging.info("=== Completed section %d/%d: %s ===", idx, total_sections, title)
 
     if args.format == "md":
@@ -185,4 +392,4 @@ def main() -> None:
             sys.exit(1)
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
@@ -2,6 +2,10 @@ import os
 import yaml
 from openai import OpenAI
 from dotenv import load_dotenv
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 # Load environment variables from .env in project root
 load_dotenv()
@@ -11,7 +15,7 @@ client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
 # 2. Load prompts
 with open("prompts.yaml") as f:
-    data = yaml.safe_load(f)
+    data = yaml.load(f, Loader=SafeLoader)
 
 # 3. Prepare a Markdown accumulator
 all_md = []
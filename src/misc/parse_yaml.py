@@ -1,8 +1,12 @@
 import yaml
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 def load_yaml(path):
     with open(path, 'r') as f:
-        return yaml.safe_load(f)
+        return yaml.load(f, Loader=SafeLoader)
 
 def print_md(node, depth=0):
     """
@@ -1,9 +1,13 @@
 import yaml
 from markdown_pdf import MarkdownPdf, Section
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 def load_yaml(path):
     with open(path, 'r') as f:
-        return yaml.safe_load(f)
+        return yaml.load(f, Loader=SafeLoader)
 
 def build_markdown(node, depth=1):
     """